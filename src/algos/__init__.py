@@ -1,4 +1,5 @@
 from src.algos.ppolag import PPOLagLoss
+from src.algos.twin_critic import TwinCritic
 from src.algos.lagrange import LagrangeBase
 from src.algos.naive_lagrange import NaiveLagrange
 from src.algos.pid_lagrange import PIDLagrange
@@ -24,6 +24,8 @@ class NaiveLagrange(LagrangeBase):
         self.register_buffer('cost_limit', torch.tensor(cost_limit))
         self.proj = torch.nn.functional.relu
         self.optim = torch.optim.Adam([self.lag], lr=lr, eps=1e-5)
+        # projected multiplier, refreshed only when lag is updated (derived from lag, so not part of the state dict)
+        self.register_buffer('lag_proj', self.proj(self.lag).detach(), persistent=False)
 
     def forward(self, tdict: TensorDictBase, cost_scale: float) -> float:
         """Computes lagrangian loss.
@@ -33,11 +35,12 @@ class NaiveLagrange(LagrangeBase):
         lagrangian_loss.backward()
         self.optim.step()
         self.optim.zero_grad()
+        self.lag_proj = self.proj(self.lag).detach()
         return lagrangian_loss
 
     def get(self):
         """Returns the current value of the lagrangian multiplier."""
-        return self.proj(self.lag).detach()
+        return self.lag_proj.clone()  # a copy, callers must not share the cached tensor
 
     def get_logs(self) -> TensorDictBase:
         """Returns a tdict with log information."""
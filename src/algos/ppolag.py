@@ -1,8 +1,57 @@
+from typing import Tuple
+
 import torch
 from tensordict import TensorDict, TensorDictBase
 from tensordict.nn import TensorDictModule, ProbabilisticTensorDictSequential
+from torch import Tensor
 from torchrl.objectives import distance_loss, ClipPPOLoss
-from torchrl.objectives.value import ValueEstimatorBase
+from torchrl.objectives.value import GAE
+from torchrl.objectives.value.functional import vec_generalized_advantage_estimate
+
+
+def vec_gae(rewards: Tensor, values: Tensor, next_values: Tensor, dones: Tensor,
+            gamma: float | Tensor, lmbda: float | Tensor, time_dim: int = -2,
+            terminated: Tensor | None = None) -> Tuple[Tensor, Tensor]:
+    """Vectorized GAE over several reward channels at once (e.g. reward and cost).
+    :param rewards: rewards of shape [*B, T, C], one channel per signal.
+    :param values: state values of shape [*B, T, C], one channel per critic.
+    :param next_values: next state values of shape [*B, T, C].
+    :param dones: end of trajectory flags of shape [*B, T, 1], shared by all channels.
+    :param gamma: discount factor.
+    :param lmbda: GAE trace decay.
+    :param time_dim: dimension where time is unrolled.
+    :param terminated: end of episode flags of shape [*B, T, 1] (no bootstrapping), defaults to dones.
+    :return: tuple (advantages, value_targets), both of shape [*B, T, C].
+    """
+    terminated = (dones if terminated is None else terminated).expand_as(rewards)
+    dones = dones.expand_as(rewards)
+    return vec_generalized_advantage_estimate(gamma, lmbda, values, next_values, rewards, dones, terminated,
+                                              time_dim=time_dim)
+
+
+def whiten(x: Tensor, eps: float = 1e-6) -> Tensor:
+    """Standardizes each channel (last dim) of x to zero mean and unit std with a single reduction,
+    keeping the statistics on device (no host sync).
+    :param x: tensor of shape [*B, C] to standardize.
+    :param eps: lower bound of the std.
+    """
+    var, mean = torch.var_mean(x, dim=tuple(range(x.ndim - 1)), keepdim=True)
+    return (x - mean) / var.sqrt().clamp_min(eps)
+
+
+def clipped_gains(ratio: Tensor, r_advantage: Tensor, c_advantage: Tensor,
+                  clip_epsilon: float | Tensor) -> Tuple[Tensor, Tensor]:
+    """Clipped surrogate objectives for reward (pessimistic min) and cost (pessimistic max).
+    :param ratio: importance weights of the current policy w.r.t. the behaviour policy.
+    :param r_advantage: reward advantages.
+    :param c_advantage: cost advantages.
+    :param clip_epsilon: clipping range of the importance weights.
+    :return: tuple (r_gain, c_gain), element-wise surrogates.
+    """
+    clipped_ratio = ratio.clamp(1. - clip_epsilon, 1. + clip_epsilon)
+    r_gain = torch.minimum(ratio * r_advantage, clipped_ratio * r_advantage)
+    c_gain = torch.maximum(ratio * c_advantage, clipped_ratio * c_advantage)
+    return r_gain, c_gain
 
 
 class PPOLagLoss(ClipPPOLoss):
@@ -11,32 +60,54 @@ class PPOLagLoss(ClipPPOLoss):
     The clipped importance weighted loss is computed as follows:
         loss = -min( weight * advantage, min(max(weight, 1-eps), 1+eps) * advantage)
 
+    If safe_critic is None, critic must write both the reward and the cost values (e.g. a TwinCritic), so that
+    each evaluation of the critics is a single forward.
+
+    If recompute_adv is True, advantages are re-estimated for every minibatch with the current critics, otherwise
+    they are read from the input tensordict when present (see estimate_advantages), e.g. computed once per rollout.
+
     """
 
     def __init__(
             self,
             actor: ProbabilisticTensorDictSequential,
             critic: TensorDictModule,
-            safe_critic: TensorDictModule,
-            r_value_estimator: ValueEstimatorBase,
-            c_value_estimator: ValueEstimatorBase,
+            safe_critic: TensorDictModule | None,
+            r_value_estimator: GAE,
+            c_value_estimator: GAE,
             *,
             target_kl: float = 0.02,
             reward_scale: float = 1.0,
             cost_scale: float = 1.0,
             beta_ema: float = 0.9,
+            compile: bool = False,
+            critic_bf16: bool = False,
+            recompute_adv: bool = False,
             **kwargs,
     ):
         super(PPOLagLoss, self).__init__(actor, critic, **kwargs)
-        self.convert_to_functional(safe_critic, 'safe_critic', create_target_params=False)
+        self.twin_critic = safe_critic is None
+        if not self.twin_critic:
+            self.convert_to_functional(safe_critic, 'safe_critic', create_target_params=False)
+        # both estimators are evaluated in a single GAE pass, so they must share hyperparameters
+        assert r_value_estimator.gamma == c_value_estimator.gamma and \
+               r_value_estimator.lmbda == c_value_estimator.lmbda and \
+               r_value_estimator.average_gae == c_value_estimator.average_gae, \
+            "reward and cost estimators must have the same gamma, lmbda and average_gae"
         self.r_value_estimator = r_value_estimator
         self.c_value_estimator = c_value_estimator
         self.register_buffer('lagrangian', torch.ones(1))
-        self.register_buffer('cost_scale', torch.tensor(cost_scale))
-        self.register_buffer('reward_scale', torch.tensor(reward_scale))
+        # scales of the reward and cost channels of ('next', 'reward'), rescaled with a single broadcast
+        self.register_buffer('reward_scales', torch.tensor([reward_scale, cost_scale]))
         self.register_buffer('target_kl', torch.tensor(target_kl))
         self.register_buffer('beta', torch.ones(1))
         self.register_buffer('beta_ema', torch.tensor(beta_ema))
+        self.critic_bf16 = critic_bf16
+        self.recompute_adv = recompute_adv
+        # tensor-only hot paths (GAE, whitening, surrogates) are compiled, tensordict bookkeeping stays eager
+        self._vec_gae = torch.compile(vec_gae, dynamic=True) if compile else vec_gae
+        self._whiten = torch.compile(whiten, dynamic=True) if compile else whiten
+        self._clipped_gains = torch.compile(clipped_gains, dynamic=True) if compile else clipped_gains
 
     @property
     def out_keys(self):
@@ -49,7 +120,61 @@ class PPOLagLoss(ClipPPOLoss):
 
     def set_lagrangian(self, lagrangian: float):
         """Updates the costs of the lagrangian multiplier."""
-        self.lagrangian = lagrangian
+        # copied in place, the multiplier may come from another device (lagrange modules live on cpu)
+        self.lagrangian.copy_(torch.as_tensor(lagrangian))
+
+    def estimate_advantages(self, tdict: TensorDictBase) -> Tuple[Tensor, Tensor]:
+        """Computes reward and cost advantages and value targets in a single vectorized GAE pass.
+        Results are also written in tdict under the keys of the respective value estimators.
+        :param tdict: TensorDict with the rollout data; ('next', 'reward') holds reward and cost channels.
+        :return: tuple (advantage, value_target), both of shape [*B, 2] (reward channel first, then cost).
+        """
+        r_keys = self.r_value_estimator.tensor_keys
+        c_keys = self.c_value_estimator.tensor_keys
+        in_keys = set(self.critic.in_keys) | (set() if self.twin_critic else set(self.safe_critic.in_keys))
+        with torch.no_grad():
+            # evaluate current and next states with one call per critic
+            values_td = torch.stack([tdict.select(*in_keys), tdict.get('next').select(*in_keys)], 0).contiguous()
+            self.critic(values_td, params=self._cached_critic_params_detached)
+            if not self.twin_critic:
+                self.safe_critic(values_td, params=self.safe_critic_params.detach())
+            values = torch.cat([values_td.get(r_keys.value), values_td.get(c_keys.value)], -1)
+
+            reward = tdict.get(('next', r_keys.reward))
+            reward = reward * self.reward_scales.to(reward.device)
+            done = traj_end = tdict.get(('next', r_keys.done))
+            if ('collector', 'traj_ids') in tdict.keys(True):
+                # collectors concatenate the rollouts of their workers (without a done in between): cut the traces
+                # wherever the trajectory changes, still bootstrapping from the next state there
+                traj_ids = tdict.get(('collector', 'traj_ids'))
+                boundary = torch.ones_like(traj_ids, dtype=torch.bool)
+                boundary[..., :-1] = traj_ids[..., :-1] != traj_ids[..., 1:]
+                traj_end = done | boundary.unsqueeze(-1)
+            advantage, value_target = self._vec_gae(reward, values[0], values[1], traj_end,
+                                                    self.r_value_estimator.gamma.to(reward.device),
+                                                    self.r_value_estimator.lmbda.to(reward.device),
+                                                    time_dim=tdict.ndim - 1, terminated=done)
+            if self.r_value_estimator.average_gae:  # standardize each channel separately
+                advantage = self._whiten(advantage, eps=1e-4)
+
+        tdict.set(r_keys.advantage, advantage[..., :1])
+        tdict.set(c_keys.advantage, advantage[..., 1:])
+        tdict.set(r_keys.value_target, value_target[..., :1])
+        tdict.set(c_keys.value_target, value_target[..., 1:])
+        return advantage, value_target
+
+    def get_advantages(self, tdict: TensorDictBase) -> Tuple[Tensor, Tensor]:
+        """Returns advantages and value targets of tdict, estimating them only if needed.
+        :param tdict: TensorDict with the rollout data.
+        :return: tuple (advantage, value_target), both of shape [*B, 2] (reward channel first, then cost).
+        """
+        r_keys = self.r_value_estimator.tensor_keys
+        c_keys = self.c_value_estimator.tensor_keys
+        if self.recompute_adv or r_keys.advantage not in tdict.keys():
+            return self.estimate_advantages(tdict)
+        advantage = torch.cat([tdict.get(r_keys.advantage), tdict.get(c_keys.advantage)], -1)
+        value_target = torch.cat([tdict.get(r_keys.value_target), tdict.get(c_keys.value_target)], -1)
+        return advantage, value_target
 
     def update_beta(self, tdict: TensorDictBase, optim: torch.optim.Optimizer, grad_clip_norm: float):
         """Compute adaptive scaling parameter beta as the ratio of un-scaled policy gradients.
@@ -57,105 +182,53 @@ class PPOLagLoss(ClipPPOLoss):
         tmp_td = tdict.clone(False)
 
         # compute advantages for both critics
-        r_tmp_td = tdict.clone(False).set(('next', 'reward'), tdict.get(('next', 'reward'))[:, :1] * self.reward_scale)
-        c_tmp_td = tdict.clone(False).set(('next', 'reward'), tdict.get(('next', 'reward'))[:, 1:] * self.cost_scale)
-
-        with torch.no_grad():
-            self.r_value_estimator(
-                r_tmp_td,
-                params=self._cached_critic_params_detached,
-                target_params=self.target_critic_params,
-            )
-            self.c_value_estimator(
-                c_tmp_td,
-                params=self.safe_critic_params.detach(),
-                target_params=self.target_safe_critic_params,
-            )
-        r_advantage = r_tmp_td.get(self.r_value_estimator.tensor_keys.advantage)
-        c_advantage = c_tmp_td.get(self.c_value_estimator.tensor_keys.advantage)
-
-        if self.normalize_advantage:
-            if r_advantage.numel() > 1:
-                loc = r_advantage.mean().item()
-                scale = r_advantage.std().clamp_min(1e-6).item()
-                r_advantage = (r_advantage - loc) / scale
-            if c_advantage.numel() > 1:
-                loc = c_advantage.mean().item()
-                scale = c_advantage.std().clamp_min(1e-6).item()
-                c_advantage = (c_advantage - loc) / scale
+        advantage, _ = self.get_advantages(tmp_td)
+        if self.normalize_advantage and advantage[..., 0].numel() > 1:  # reward and cost channels at once
+            advantage = self._whiten(advantage)
+        r_advantage, c_advantage = advantage[..., :1], advantage[..., 1:]
 
         # compute actor loss
         pi_logratio, dist = self._log_weight(tmp_td)
         pi_ratio = pi_logratio.exp()
-        clipped_ratio = pi_ratio.clamp(1. - self.clip_epsilon, 1. + self.clip_epsilon)
         # compute surrogate losses for both reward and cost
-        r_gain1 = pi_ratio * r_advantage
-        r_gain2 = clipped_ratio * r_advantage
-        r_gain = - torch.stack([r_gain1, r_gain2], -1).min(dim=-1)[0]
-        c_gain1 = pi_ratio * c_advantage
-        c_gain2 = clipped_ratio * c_advantage
-        c_gain = torch.stack([c_gain1, c_gain2], -1).max(dim=-1)[0]
+        r_gain, c_gain = self._clipped_gains(pi_ratio, r_advantage, c_advantage, self.clip_epsilon)
+        r_gain = - r_gain
 
         optim.zero_grad()
         r_gain.mean().backward(retain_graph=True)
         r_grad_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), grad_clip_norm)
-        r_grad_norm = torch.minimum(r_grad_norm, torch.tensor(grad_clip_norm))
+        r_grad_norm = r_grad_norm.clamp_max(grad_clip_norm)
         optim.zero_grad()
         c_gain.mean().backward()
         c_grad_norm = torch.nn.utils.clip_grad_norm_(self.parameters(), grad_clip_norm)
-        c_grad_norm = torch.minimum(c_grad_norm, torch.tensor(grad_clip_norm))
+        c_grad_norm = c_grad_norm.clamp_max(grad_clip_norm)
         optim.zero_grad()
 
         self.beta = self.beta_ema * self.beta + ((1 - self.beta_ema) * r_grad_norm / c_grad_norm)
 
     def forward(self, tdict: TensorDictBase) -> TensorDictBase:
-        tmp_td = tdict.clone(False)
+        # tdict is written in place (values, advantages, policy outputs): pass a copy if it must be preserved
         td_out = TensorDict({}, [])
+        # attributes used more than once are looked up a single time
+        lagrangian = self.lagrangian
+        critic_coef, loss_critic_type = self.critic_coef, self.loss_critic_type
 
         # compute advantages for both critics
-        r_tmp_td = tdict.clone(False).set(('next', 'reward'), tdict.get(('next', 'reward'))[:, :1] * self.reward_scale)
-        c_tmp_td = tdict.clone(False).set(('next', 'reward'), tdict.get(('next', 'reward'))[:, 1:] * self.cost_scale)
-
-        with torch.no_grad():
-            self.r_value_estimator(
-                r_tmp_td,
-                params=self._cached_critic_params_detached,
-                target_params=self.target_critic_params,
-            )
-            self.c_value_estimator(
-                c_tmp_td,
-                params=self.safe_critic_params.detach(),
-                target_params=self.target_safe_critic_params,
-            )
-        r_advantage = r_tmp_td.get(self.r_value_estimator.tensor_keys.advantage)
-        c_advantage = c_tmp_td.get(self.c_value_estimator.tensor_keys.advantage)
-
-        if self.normalize_advantage:
-            if r_advantage.numel() > 1:
-                loc = r_advantage.mean().item()
-                scale = r_advantage.std().clamp_min(1e-6).item()
-                r_advantage = (r_advantage - loc) / scale
-            if c_advantage.numel() > 1:
-                loc = c_advantage.mean().item()
-                scale = c_advantage.std().clamp_min(1e-6).item()
-                c_advantage = (c_advantage - loc) / scale
+        advantage, value_target = self.get_advantages(tdict)
+        if self.normalize_advantage and advantage[..., 0].numel() > 1:  # reward and cost channels at once
+            advantage = self._whiten(advantage)
+        r_advantage, c_advantage = advantage[..., :1], advantage[..., 1:]
 
         # compute actor loss
-        pi_logratio, dist = self._log_weight(tmp_td)
+        pi_logratio, dist = self._log_weight(tdict)
         pi_ratio = pi_logratio.exp()
         approx_kl = ((pi_ratio - 1) - pi_logratio).mean()  # kl estimator, see http://joschu.net/blog/kl-approx.html
         td_out.set("approx_kl", approx_kl)
         if approx_kl <= self.target_kl:  # early stopping if kl-divergence is too large
-            clipped_ratio = pi_ratio.clamp(1. - self.clip_epsilon, 1. + self.clip_epsilon)
             # compute surrogate losses for both reward and cost
-            r_gain1 = pi_ratio * r_advantage
-            r_gain2 = clipped_ratio * r_advantage
-            r_gain = torch.stack([r_gain1, r_gain2], -1).min(dim=-1)[0]
-            c_gain1 = pi_ratio * c_advantage
-            c_gain2 = clipped_ratio * c_advantage
-            c_gain = torch.stack([c_gain1, c_gain2], -1).max(dim=-1)[0]
-
-            loss_pi = (-r_gain + self.lagrangian * self.beta * c_gain).mean() / (1 + self.lagrangian)
+            r_gain, c_gain = self._clipped_gains(pi_ratio, r_advantage, c_advantage, self.clip_epsilon)
+
+            loss_pi = (-r_gain + lagrangian * self.beta * c_gain).mean() / (1 + lagrangian)
             td_out.set("loss_pi", loss_pi)
 
         # ESS for logging
@@ -167,28 +240,28 @@ class PPOLagLoss(ClipPPOLoss):
 
         # compute entropy and entropy loss
         if self.entropy_bonus:
-            entropy = self.get_entropy_bonus(dist)
-            td_out.set("loss_entropy", -self.entropy_coef * entropy.mean())
-            td_out.set("entropy", entropy.mean().detach())
+            entropy = self.get_entropy_bonus(dist).mean()
+            td_out.set("loss_entropy", -self.entropy_coef * entropy)
+            td_out.set("entropy", entropy.detach())
 
         # compute critics losses
-        target = r_tmp_td.get(self.r_value_estimator.tensor_keys.value_target)
-        pred = self.critic(r_tmp_td, params=self.critic_params).get(self.r_value_estimator.tensor_keys.value)
-        loss_r_critic = self.critic_coef * distance_loss(
-            target, pred,
-            loss_function=self.loss_critic_type
-        )
-        td_out.set('preds_reward', pred.detach())
-        td_out.set('targets_reward', target.detach())
-
-        target = c_tmp_td.get(self.c_value_estimator.tensor_keys.value_target)
-        pred = self.safe_critic(c_tmp_td, params=self.safe_critic_params).get(self.c_value_estimator.tensor_keys.value)
-        loss_c_critic = self.critic_coef * distance_loss(
-            target, pred,
-            loss_function=self.loss_critic_type
-        )
-        td_out.set('preds_constraint', pred.detach())
-        td_out.set('targets_constraint', target.detach())
+        # value regression is robust to reduced precision: optionally run critics and their losses in bf16
+        with torch.autocast(device_type=value_target.device.type, dtype=torch.bfloat16, enabled=self.critic_bf16):
+            self.critic(tdict, params=self.critic_params)
+            if not self.twin_critic:
+                self.safe_critic(tdict, params=self.safe_critic_params)
+
+            target = value_target[..., :1]
+            pred = tdict.get(self.r_value_estimator.tensor_keys.value)
+            loss_r_critic = critic_coef * distance_loss(target, pred, loss_function=loss_critic_type)
+            td_out.set('preds_reward', pred.detach().float())
+            td_out.set('targets_reward', target.detach())
+
+            target = value_target[..., 1:]
+            pred = tdict.get(self.c_value_estimator.tensor_keys.value)
+            loss_c_critic = critic_coef * distance_loss(target, pred, loss_function=loss_critic_type)
+            td_out.set('preds_constraint', pred.detach().float())
+            td_out.set('targets_constraint', target.detach())
 
         td_out.set("loss_r_critic", loss_r_critic.mean())
         td_out.set("loss_c_critic", loss_c_critic.mean())
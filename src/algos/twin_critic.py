@@ -0,0 +1,47 @@
+from typing import Tuple
+
+import torch
+from torch import nn, Tensor
+
+
+class TwinCritic(nn.Module):
+    """Reward and cost critics with the same architecture, evaluated in a single batched forward.
+
+    The weights of the two critics are kept separate but stacked as [2, in, out], so that each layer of both
+    critics is computed with one batched matmul.
+    """
+
+    def __init__(self, critic_net: nn.Sequential, safe_critic_net: nn.Sequential):
+        """Initializes the module, copying the (already initialized) weights of the two critics.
+        :param critic_net: reward critic, a sequence of linear layers and activations (e.g. torchrl MLP).
+        :param safe_critic_net: cost critic, with the same layers as critic_net.
+        """
+        super().__init__()
+        r_layers = [m for m in critic_net if isinstance(m, nn.Linear)]
+        c_layers = [m for m in safe_critic_net if isinstance(m, nn.Linear)]
+        assert [l.weight.shape for l in r_layers] == [l.weight.shape for l in c_layers], \
+            "reward and cost critics must have the same architecture"
+        for i, (r_layer, c_layer) in enumerate(zip(r_layers, c_layers)):
+            weight = torch.stack([r_layer.weight.data.T, c_layer.weight.data.T]).contiguous()
+            bias = torch.stack([r_layer.bias.data, c_layer.bias.data]).unsqueeze(1)
+            self.register_parameter(f'weight_{i}', nn.Parameter(weight))
+            self.register_parameter(f'bias_{i}', nn.Parameter(bias))
+        self.num_layers = len(r_layers)
+        self.activation = next((m for m in critic_net if not isinstance(m, nn.Linear)), nn.Identity())
+        # whether the activation is also applied to the output, for the reward and cost critic respectively
+        self.activate_last = (not isinstance(critic_net[-1], nn.Linear), not isinstance(safe_critic_net[-1], nn.Linear))
+
+    def forward(self, observation: Tensor) -> Tuple[Tensor, Tensor]:
+        """Returns the reward and cost values of the observations, both of shape [*B, 1]."""
+        batch_shape = observation.shape[:-1]
+        x = observation.reshape(1, -1, observation.shape[-1]).expand(2, -1, -1)
+        for i in range(self.num_layers):
+            x = torch.baddbmm(getattr(self, f'bias_{i}'), x, getattr(self, f'weight_{i}'))
+            if i < self.num_layers - 1:
+                x = self.activation(x)
+        r_value, c_value = x.unbind(0)
+        if self.activate_last[0]:
+            r_value = self.activation(r_value)
+        if self.activate_last[1]:
+            c_value = self.activation(c_value)
+        return r_value.reshape(*batch_shape, -1), c_value.reshape(*batch_shape, -1)
@@ -4,16 +4,18 @@ import shutil
 import hydra
 import omegaconf
 import torch
+import torch.distributed as dist
 import wandb
 from omegaconf import DictConfig
 from torchrl.collectors import MultiSyncDataCollector
-from torchrl.data import TensorDictReplayBuffer, LazyMemmapStorage
+from torchrl.data import TensorDictReplayBuffer, LazyTensorStorage
 from torchrl.data.replay_buffers import SamplerWithoutReplacement
 from torchrl.envs import SerialEnv, ParallelEnv
 from tqdm import tqdm
 
 from src.envs import VPPEnv
-from src.utils.training import make_env, train_loop, get_agent_modules, seed_everything
+from src.utils.training import make_env, train_loop, get_agent_modules, seed_everything, init_distributed, \
+    broadcast_module
 
 
 def init_wandb(cfg):
@@ -71,30 +73,34 @@ def init_wandb(cfg):
 @hydra.main(version_base="1.1", config_path="../configs", config_name="train.yaml")
 def main(cfg: DictConfig) -> None:
     """
-    Entry point for training.
+    Entry point for training. Can be launched with torchrun (e.g. torchrun --nproc_per_node=N src/train.py) to run
+    one learner per process, each with its own collector, with gradients averaged across processes.
     :param cfg: DictConfig; Hydra configuration object.
     """
-    if not os.path.isdir(cfg.training.save_dir):
+    rank, world_size, device = init_distributed(torch.device(cfg.training.device))
+    is_main = rank == 0
+    if is_main and not os.path.isdir(cfg.training.save_dir):
         os.makedirs(cfg.training.save_dir)
 
-    # Set seed
+    # Set seed, modules are initialized identically on all ranks
     seed_everything(cfg.seed)
 
-    # Set device and total frames
-    device = torch.device(cfg.training.device)
+    # Set total frames (per rank)
     total_frames = cfg.training.frames_per_batch * cfg.training.iterations
 
     # Create env to initialize modules and normalization state dict
     env = make_env(device=device, instances=cfg.environment.instances.train,
                    **cfg.environment.params)
     loss_module, lag_module, policy_module, nets = get_agent_modules(env, cfg, device)
+    broadcast_module(loss_module)
+    broadcast_module(env.transform[0])
     t_state_dict = env.transform[0].state_dict()
     del env
 
     env_kwargs = [{'device': device, 't_state_dict': t_state_dict, 'wandb_run': None,
                    'instances': cfg.environment.instances.train, **cfg.environment.params}] * cfg.training.num_envs
     # Initialize wandb
-    if cfg.wandb.use_wandb:
+    if cfg.wandb.use_wandb and is_main:
         init_wandb(cfg)
         env_kwargs[0]['wandb_run'] = wandb.run  # only log from the first training env
 
@@ -107,47 +113,60 @@ def main(cfg: DictConfig) -> None:
         total_frames=total_frames,
         split_trajs=False,
         device=device,
+        # stop all workers once this ratio of them is done, so that slow envs do not stall the learner
+        preemptive_threshold=cfg.training.preemptive_threshold,
     )
-    collector.set_seed(cfg.seed)
+    collector.set_seed(cfg.seed + rank)  # each rank collects different rollouts
+    storage_device = torch.device(cfg.training.storage_device) if cfg.training.storage_device else device
     replay_buffer = TensorDictReplayBuffer(
         batch_size=cfg.training.batch_size,
-        storage=LazyMemmapStorage(cfg.training.frames_per_batch),
-        prefetch=cfg.training.num_epochs,
+        # on-policy data is discarded every iteration, keep it in memory (by default on the training device)
+        storage=LazyTensorStorage(cfg.training.frames_per_batch, device=storage_device),
+        # batches prefetched before a (preempted, shorter) rollout replaces the data could be sampled from the old one
+        prefetch=cfg.training.num_epochs if cfg.training.preemptive_threshold is None else None,
         sampler=SamplerWithoutReplacement()  # for PPO only, ensures the entire dataset is used
     )
 
-    valid_env = ParallelEnv(num_workers=len(cfg.environment.instances.valid), create_env_fn=make_env,
-                            create_env_kwargs=[
-                                {'device': device, 't_state_dict': t_state_dict, 'fixed_noise': True,
-                                 **cfg.environment.params,
-                                 'instances': [instance]} for instance in cfg.environment.instances.valid])
-    if cfg.environment.instances.test not in (None, 'None'):  # wandb sweep sends None as string
-        test_env = SerialEnv(num_workers=len(cfg.environment.instances.test), create_env_fn=make_env,
-                             create_env_kwargs=[
-                                 {'device': device, 't_state_dict': t_state_dict, 'fixed_noise': True,
-                                  **cfg.environment.params,
-                                  'instances': [instance]} for instance in cfg.environment.instances.test])
-        test_env.reset()
-    else:
-        test_env = valid_env
-    valid_env.reset()
-
+    valid_env = test_env = None  # evaluation is done by rank 0 only
+    if is_main:
+        valid_env = ParallelEnv(num_workers=len(cfg.environment.instances.valid), create_env_fn=make_env,
+                                create_env_kwargs=[
+                                    {'device': device, 't_state_dict': t_state_dict, 'fixed_noise': True,
+                                     **cfg.environment.params,
+                                     'instances': [instance]} for instance in cfg.environment.instances.valid])
+        if cfg.environment.instances.test not in (None, 'None'):  # wandb sweep sends None as string
+            test_env = SerialEnv(num_workers=len(cfg.environment.instances.test), create_env_fn=make_env,
+                                 create_env_kwargs=[
+                                     {'device': device, 't_state_dict': t_state_dict, 'fixed_noise': True,
+                                      **cfg.environment.params,
+                                      'instances': [instance]} for instance in cfg.environment.instances.test])
+            test_env.reset()
+        else:
+            test_env = valid_env
+        valid_env.reset()
+
+    # single fused kernel for all parameters on cuda, multi-tensor (foreach) update otherwise
+    fused = device.type == 'cuda'
     optim = torch.optim.Adam([
         {'params': [p for k, p in loss_module.named_parameters() if 'critic' in k], 'lr': cfg.agent.critic_lr},
         {'params': [p for k, p in loss_module.named_parameters() if 'actor' in k],
          'lr': cfg.agent.actor_lr, 'weight_decay': cfg.agent.actor_weight_decay},
-    ], eps=1e-5)
+    ], eps=1e-5, fused=fused, foreach=not fused)
     if cfg.agent.schedule:  # square-summable, non-summable step sizes
         scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optim, T_max=cfg.training.iterations, eta_min=1e-6)
     else:
         scheduler = torch.optim.lr_scheduler.LambdaLR(optim, lambda _: 1.)
 
-    pbar = tqdm(total=total_frames, desc="Training", unit=" frames")
+    pbar = tqdm(total=total_frames, desc="Training", unit=" frames", disable=not is_main)
     train_loop(cfg=cfg, collector=collector, device=device, valid_env=valid_env, test_env=test_env,
                loss_module=loss_module, lag_module=lag_module, optim=optim, pbar=pbar, policy_module=policy_module,
                replay_buffer=replay_buffer, scheduler=scheduler)
 
     # clean up
+    if world_size > 1:
+        dist.destroy_process_group()
+    if not is_main:
+        return
     shutil.rmtree(cfg.training.save_dir)
     wandb_dir = wandb.run.dir[:-6] if 'files' in wandb.run.dir else wandb.run.dir
     wandb.finish()
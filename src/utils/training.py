@@ -6,6 +6,7 @@ import numpy as np
 import pandas as pd
 
 import torch
+import torch.distributed as dist
 import tqdm
 import wandb
 from omegaconf import ListConfig, DictConfig
@@ -23,7 +24,7 @@ from torchrl.objectives.value import GAE
 from torchrl.envs.utils import ExplorationType, set_exploration_type
 
 from src.envs import StandardVPPEnv, CumulativeVPPEnv, SafeGridWorld
-from src.algos import PPOLagLoss, NaiveLagrange, PIDLagrange, LagrangeBase
+from src.algos import PPOLagLoss, NaiveLagrange, PIDLagrange, LagrangeBase, TwinCritic
 
 ########################################################################################################################
 
@@ -33,6 +34,10 @@ VARIANTS = ['toy', 'standard', 'cumulative']
 CONTROLLERS = ['rl', 'unify']
 RL_ALGOS = ['ppo', 'ppolag']
 
+# rollout entries that are only used for logging, never read by the losses: they are not stored in the replay buffer
+LOG_ONLY_KEYS = ['loc', 'scale', 'collector', 'instance', 'episode_reward', 'step_count',
+                 ('next', 'instance'), ('next', 'episode_reward'), ('next', 'step_count')]
+
 wandb_running = lambda: wandb.run is not None
 
 
@@ -44,6 +49,55 @@ def seed_everything(seed: int):
     torch.cuda.manual_seed_all(seed)
 
 
+def init_distributed(device: torch.device) -> Tuple[int, int, torch.device]:
+    """Initializes the default process group when launched with torchrun (one learner per process).
+    :param device: torch device from the config; cuda devices are mapped to the local rank.
+    :return: tuple (rank, world_size, device); (0, 1, device) when not running distributed.
+    """
+    if 'WORLD_SIZE' not in os.environ or int(os.environ['WORLD_SIZE']) == 1:
+        return 0, 1, device
+    if device.type == 'cuda':
+        device = torch.device('cuda', int(os.environ['LOCAL_RANK']))
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend='nccl' if device.type == 'cuda' else 'gloo')
+    return dist.get_rank(), dist.get_world_size(), device
+
+
+def broadcast_module(module: nn.Module, src: int = 0):
+    """Copies parameters and buffers of module from rank src to all other ranks."""
+    if dist.is_initialized():
+        for t in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(t.data, src)
+
+
+def all_reduce_gradients(module: nn.Module):
+    """Averages the gradients of module across ranks with a single all-reduce.
+    Missing gradients (e.g. policy skipped by kl early stopping) count as zeros, so all ranks stay in lockstep;
+    parameters without a gradient on every rank are left with grad None, as in single-process training.
+    """
+    params = list(module.parameters())
+    # one flag per parameter, appended to the gradients to count the ranks that produced them
+    has_grad = torch.tensor([p.grad is not None for p in params], dtype=params[0].dtype, device=params[0].device)
+    flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)).reshape(-1) for p in params]
+                     + [has_grad])
+    dist.all_reduce(flat)
+    has_grad = flat[-len(params):] > 0
+    flat /= dist.get_world_size()
+    offset = 0
+    for p, p_has_grad in zip(params, has_grad.tolist()):
+        p.grad = flat[offset:offset + p.numel()].view_as(p).clone() if p_has_grad else None
+        offset += p.numel()
+
+
+def all_reduce_mean(x: Tensor) -> Tensor:
+    """Returns the mean of x across ranks (x itself when not running distributed)."""
+    if not dist.is_initialized():
+        return x
+    x = x.clone()
+    dist.all_reduce(x)
+    return x / dist.get_world_size()
+
+
 ########################################################################################################################
 def make_env(device: torch.device,
              env_type: str,
@@ -238,14 +292,21 @@ def get_agent_modules(env: EnvBase,
         if cfg.agent.orthogonal_init:
             orthogonal_init(safe_critic_net, 0.01)
 
-        r_value_module = ValueOperator(module=critic_net, in_keys=["observation"], out_keys=["r_state_value"])
-        c_value_module = ValueOperator(module=safe_critic_net, in_keys=["observation"], out_keys=["c_state_value"])
-        init_module(r_value_module, 'reward value function')
-        init_module(c_value_module, 'constraint value function')
+        if cfg.critic.twin:  # both critics evaluated in a single forward
+            r_value_module = ValueOperator(module=TwinCritic(critic_net, safe_critic_net), in_keys=["observation"],
+                                           out_keys=["r_state_value", "c_state_value"])
+            c_value_module = None
+            init_module(r_value_module, 'reward and constraint value functions')
+        else:
+            r_value_module = ValueOperator(module=critic_net, in_keys=["observation"], out_keys=["r_state_value"])
+            c_value_module = ValueOperator(module=safe_critic_net, in_keys=["observation"], out_keys=["c_state_value"])
+            init_module(r_value_module, 'reward value function')
+            init_module(c_value_module, 'constraint value function')
 
         r_advantage_module = GAE(value_network=r_value_module, average_gae=True, **cfg.agent.estimator)
         r_advantage_module.set_keys(advantage='r_advantage', value_target='r_value_target', value='r_state_value')
-        c_advantage_module = GAE(value_network=c_value_module, average_gae=True, **cfg.agent.estimator)
+        c_advantage_module = GAE(value_network=c_value_module or r_value_module, average_gae=True,
+                                 **cfg.agent.estimator)
         c_advantage_module.set_keys(advantage='c_advantage', value_target='c_value_target', value='c_state_value')
 
         if cfg.agent.lagrange.type == 'naive':
@@ -266,19 +327,57 @@ def get_agent_modules(env: EnvBase,
             **cfg.agent.loss_module,
             **cfg.agent.loss_module_lag
         )
-        nets = (actor_net, critic_net, safe_critic_net)
+        nets = (actor_net, r_value_module.module) if cfg.critic.twin else (actor_net, critic_net, safe_critic_net)
     else:
         raise ValueError(f'Unknown algorithm {cfg.agent.algo}, either ppo or ppolag')
 
+    # buffers and parameters created without a device (e.g. actor scale) must be on device, e.g. for nccl broadcasts;
+    # the policy shares its parameters with the loss module, so it is moved as well
+    loss_module.to(device)
     return loss_module, lag_module, policy_module, nets
 
 
-def evaluate(eval_env: EnvBase, policy_module: ProbabilisticActor, optimal_scores: dict, cost_limit: int,
+def sample_batches(replay_buffer: TensorDictReplayBuffer, num_batches: int, batch_size: int, device: torch.device):
+    """Yields num_batches minibatches from the replay buffer, moved to device.
+    When the buffer lives on cpu and device is cuda, each minibatch is pinned and copied on a side stream
+    while the previous one is being used, so the host-to-device copy is off the critical path.
+    :param replay_buffer: replay buffer to sample from.
+    :param num_batches: number of minibatches to yield.
+    :param batch_size: size of each minibatch.
+    :param device: device used by the loss.
+    """
+    if device.type != 'cuda':
+        for _ in range(num_batches):
+            yield replay_buffer.sample(batch_size).to(device)
+        return
+
+    stream = torch.cuda.Stream(device)
+
+    def load():
+        batch = replay_buffer.sample(batch_size)
+        if batch.device == device:
+            return batch
+        batch = batch.pin_memory()
+        with torch.cuda.stream(stream):
+            return batch.to(device, non_blocking=True)
+
+    next_batch = load()
+    for b in range(num_batches):
+        torch.cuda.current_stream(device).wait_stream(stream)
+        batch = next_batch
+        for t in batch.values(True, True):  # memory was allocated on the side stream
+            t.record_stream(torch.cuda.current_stream(device))
+        if b < num_batches - 1:
+            next_batch = load()
+        yield batch
+
+
+def evaluate(eval_env: EnvBase, policy_module: ProbabilisticActor, optimal_scores: Tensor, cost_limit: int,
              log_type='avg', stoch_rollouts=10):
     """Evaluate the policy on the evaluation environment.
     :param eval_env: environment to evaluate on.
     :param policy_module: policy to evaluate.
-    :param optimal_scores: optimal costs for each instance in the evaluation environment.
+    :param optimal_scores: optimal costs of the instances in the evaluation environment, see load_optimal_scores.
     :param cost_limit: cost limit of the agent.
     :param log_type: either 'avg' or 'all', whether to log all scores or just the average.
     """
@@ -293,8 +392,7 @@ def evaluate(eval_env: EnvBase, policy_module: ProbabilisticActor, optimal_score
                 eval_rollout = eval_env.rollout(100, policy_module)
             rewards = get_rollout_scores(eval_rollout)
             # normalize scores according to optimal score of each instance
-            optimal_scores_tensor = torch.as_tensor([float(optimal_scores[int(instance)])
-                                                     for instance in rewards[:, 2]])
+            optimal_scores_tensor = optimal_scores.to(rewards.device)[rewards[:, 2].long()]
             # note the following 3 vars refer to episode (cumulative) values
             all_costs = rewards[:, 1]
             all_scores = -optimal_scores_tensor / rewards[:, 0]
@@ -340,6 +438,69 @@ def get_rollout_scores(rollout_td: TensorDictBase) -> Tensor | Tuple[float, floa
     return rewards
 
 
+def load_optimal_scores(instances) -> Tensor:
+    """Load the optimal (oracle) costs of the given instances into a lookup tensor.
+    :param instances: iterable of instance ids.
+    :return: tensor indexed by instance id, NaN for instances that were not loaded.
+    """
+    instances = [int(instance) for instance in instances]
+    optimal_scores = torch.full((max(instances) + 1,), float('nan'))
+    for instance in instances:
+        optimal_scores[instance] = float(np.load(hydra.utils.to_absolute_path(f'src/data/oracle/{instance}_cost.npy')))
+    return optimal_scores
+
+
+def buffer_step_log(step_logs: TensorDictBase, loss_info: TensorDictBase, step: int, batch_size: int) -> None:
+    """Writes the losses and debug info of an optimization step in the preallocated step_logs, on device.
+    Entries are allocated the first time their key is seen (i.e. once per run), then reused across iterations:
+    values are stored under ('values', key) and which of them were written at each step under ('logged', key).
+    :param step_logs: TensorDict of shape [num_steps] with (empty at first) 'values' and 'logged' entries.
+    :param loss_info: output of the loss module.
+    :param step: index of the optimization step in the iteration.
+    :param batch_size: size of the minibatches, upper bound of the first dim of non-scalar entries.
+    """
+    all_values, all_logged = step_logs.get('values'), step_logs.get('logged')
+    for k, v in loss_info.items():
+        try:
+            values, logged = all_values.get(k), all_logged.get(k)
+        except KeyError:
+            shape = (*step_logs.batch_size, *v.shape) if v.ndim == 0 else \
+                (*step_logs.batch_size, max(batch_size, v.shape[0]), *v.shape[1:])
+            values = torch.zeros(shape, device=step_logs.device)
+            logged = torch.zeros(shape, dtype=torch.bool, device=step_logs.device)
+            all_values.set(k, values)
+            all_logged.set(k, logged)
+        if v.ndim == 0:
+            values[step] = v.detach()
+            logged[step] = True
+        else:
+            values[step, :v.shape[0]] = v.detach()
+            logged[step, :v.shape[0]] = True
+
+
+def flush_step_logs(step_logs: TensorDictBase, train_step: int) -> int:
+    """Logs the buffered steps of one iteration to wandb, one log per step, and resets the buffer.
+    :param step_logs: TensorDict of shape [num_steps] filled by buffer_step_log.
+    :param train_step: wandb step of the first buffered step.
+    :return: wandb step of the next optimization step.
+    """
+    # a single transfer per iteration
+    values = {k: v.cpu().numpy() for k, v in step_logs.get('values').items()}
+    logged = {k: v.cpu().numpy() for k, v in step_logs.get('logged').items()}
+    for step in range(step_logs.batch_size[0]):
+        batch_log = dict()
+        for k, v in values.items():
+            v = v[step][logged[k][step]]
+            if v.size > 0:  # to log both scalars and arrays
+                batch_log[f"{'train' if k.startswith('loss_') else 'debug'}/{k}"] = v.item() if v.size == 1 else v
+        if not batch_log:  # fewer steps than the buffer size were taken (preempted rollout)
+            continue
+        wandb.log({'train_step': train_step, **batch_log})
+        train_step += 1
+    step_logs.get('logged').apply_(lambda x: x.zero_())
+    return train_step
+
+
 def final_evaluation(cost_limit, eval_env, optimal_scores, policy_module, prefix):
     eval_log, _ = evaluate(eval_env, policy_module, optimal_scores, cost_limit, log_type='all')
     assert all(isinstance(h, float) or len(h) == 96 for h in eval_log.values()), "Not all histories have length 96"
@@ -378,69 +539,95 @@ def train_loop(cfg: DictConfig,
     :param policy_module: policy module object, used for evaluation
     :param replay_buffer: replay buffer
     :param scheduler: learning rate scheduler
+
+    When running distributed, each rank collects its own rollouts and gradients are averaged across ranks;
+    evaluation, checkpointing and logging are done by rank 0 only.
     """
-    optimal_train_scores = {instance: np.load(hydra.utils.to_absolute_path(f'src/data/oracle/{instance}_cost.npy'))
-                            for instance in cfg.environment.instances.train}
-    optimal_valid_scores = {instance: np.load(hydra.utils.to_absolute_path(f'src/data/oracle/{instance}_cost.npy'))
-                            for instance in cfg.environment.instances.valid}
+    distributed = dist.is_initialized()
+    is_main = not distributed or dist.get_rank() == 0
+    optimal_train_scores = load_optimal_scores(cfg.environment.instances.train)
+    optimal_valid_scores = load_optimal_scores(cfg.environment.instances.valid)
     num_batches = cfg.training.frames_per_batch // cfg.training.batch_size
     cost_limit = cfg.agent.lagrange.params.cost_limit
     train_step = 0
+    # losses and debug info of each optimization step, buffered on device and logged once per iteration
+    step_logs = TensorDict({'values': {}, 'logged': {}}, [cfg.training.num_epochs * num_batches], device=device)
     # keep track of best iterate
     best_score = 1000
     best_it = None
 
     # Iterate over the collector until it reaches frames_per_batch frames
     for it, rollout_td in enumerate(collector):
+        num_frames = rollout_td.numel()
+        if cfg.training.preemptive_threshold is not None:
+            # preempted workers leave the tail of their rollout unfilled, marked with trajectory id -1
+            rollout_td = rollout_td[rollout_td.get(('collector', 'traj_ids')) != -1]
         # get dones to compute average cumulative reward and constraint cost and violation
         rewards = get_rollout_scores(rollout_td)
-        avg_cost = rewards[:, 1].mean().item()
-        avg_violation = (rewards[:, 1] - cost_limit).mean().item()
-        surrogate_score = abs(avg_cost - cost_limit)
+        # the lagrangian is updated with statistics of all ranks, so that it stays the same everywhere
+        # reduced and moved to the (cpu) lagrange module in a single transfer
+        avg_cost, avg_violation = all_reduce_mean(torch.stack([rewards[:, 1].mean(),
+                                                               (rewards[:, 1] - cost_limit).mean()])).cpu().unbind()
+        surrogate_score = abs(avg_cost.item() - cost_limit)
         if cfg.agent.lagrange.positive_violation:
-            avg_violation = max(0., avg_violation)
+            avg_violation = avg_violation.clamp_min(0.)
         cost_td = TensorDict({'avg_cost': avg_cost, 'avg_violation': avg_violation}, [])
 
         if cfg.agent.algo == 'ppolag':
             # Optimization: update lagrangian
             loss_lagrangian = lag_module(cost_td, cost_scale=cfg.agent.loss_module_lag.cost_scale)
             loss_module.set_lagrangian(lag_module.get())
+            if not loss_module.recompute_adv:  # advantages are estimated once and stored with the rollout
+                loss_module.estimate_advantages(rollout_td)
 
             if cfg.agent.use_beta:
                 loss_module.update_beta(rollout_td, optim, cfg.training.max_grad_norm)
+                loss_module.beta = all_reduce_mean(loss_module.beta)
         else:
             rollout_td['next', 'reward'] = rollout_td['next', 'reward'][:, 0]
             loss_lagrangian = 0.
-        replay_buffer.extend(rollout_td.reshape(-1).cpu())
+        if cfg.training.preemptive_threshold is not None:
+            # rollouts can be shorter than frames_per_batch, drop the previous one instead of overwriting part of it
+            # (the replay buffer is built without prefetching in this case, so that no stale batch is queued)
+            replay_buffer.empty()
+        replay_buffer.extend(rollout_td.exclude(*LOG_ONLY_KEYS).reshape(-1))
+        iter_batches = num_batches
+        if cfg.training.preemptive_threshold is not None:
+            # as many minibatches as the (possibly shorter) rollout fills, the same on all ranks to stay in lockstep
+            iter_batches = torch.tensor(max(1, len(replay_buffer) // cfg.training.batch_size), device=device)
+            if distributed:
+                dist.all_reduce(iter_batches, op=dist.ReduceOp.MIN)
+            iter_batches = int(iter_batches.item())
 
         # Optimization: compute loss and optimize
         for epoch in range(cfg.training.num_epochs):
-            for b in range(num_batches):
-                subdata = replay_buffer.sample(cfg.training.batch_size)
-                loss_info = loss_module(subdata.to(device))
+            for b, subdata in enumerate(sample_batches(replay_buffer, iter_batches, cfg.training.batch_size, device)):
+                loss_info = loss_module(subdata)
                 loss_value = sum(loss_info[k] for k in loss_info.keys() if k.startswith('loss_'))
                 # Optimization: backward, grad clipping and optim step
                 loss_value.backward()
+                if distributed:
+                    all_reduce_gradients(loss_module)
                 torch.nn.utils.clip_grad_norm_(loss_module.parameters(), cfg.training.max_grad_norm)
                 optim.step()
                 optim.zero_grad()
                 # Log the losses and debug info
-                if cfg.wandb.use_wandb:
-                    batch_log = {f"{'train' if k.startswith('loss_') else 'debug'}/{k}":
-                                     (v.item() if v.numel() == 1 else v.numpy())  # to log both scalars and arrays
-                                 for k, v in loss_info.items()}
-                    wandb.log({'train_step': train_step, **batch_log})
-                    train_step += 1
+                if cfg.wandb.use_wandb and is_main:
+                    buffer_step_log(step_logs, loss_info, epoch * iter_batches + b, cfg.training.batch_size)
+        if cfg.wandb.use_wandb and is_main:
+            train_step = flush_step_logs(step_logs, train_step)
 
         scheduler.step()
+        pbar.update(num_frames)
+        if not is_main:
+            continue
 
         train_log = {'train/iteration': it,
                      # normalize score according to each rollout instance's optimal score
-                     'train/avg_score': (-torch.as_tensor([float(optimal_train_scores[int(instance)])
-                                                           for instance in rewards[:, 2]])
-                                         / rewards[:, 0]).mean().item(),
-                     'train/avg_cost': avg_cost,
-                     'train/avg_violation': max(0, avg_violation) / (1000 - cost_limit),
+                     'train/avg_score': (-optimal_train_scores[rewards[:, 2].long().cpu()]
+                                         / rewards[:, 0].cpu()).mean().item(),
+                     'train/avg_cost': avg_cost.item(),
+                     'train/avg_violation': max(0, avg_violation.item()) / (1000 - cost_limit),
                      'train/surrogate_score': surrogate_score,
                      'train/loss_lagrangian': loss_lagrangian,
                      'debug/actor_lr': optim.param_groups[0]["lr"],
@@ -470,7 +657,6 @@ def train_loop(cfg: DictConfig,
             train_log['train/loc_in_range'] = (rollout_td['loc'][:, 0].max() - rollout_td['loc'][:, 0].min()).item()
             train_log['train/loc_out_range'] = (rollout_td['loc'][:, 1].max() - rollout_td['loc'][:, 1].min()).item()
 
-        pbar.update(rollout_td.numel())
         train_str = f"[T] reward: {train_log['train/avg_score']: 1.2f}, " \
                     f"violation: {train_log['train/avg_violation']: 1.2f}, " \
                     f"cost: {train_log['train/avg_cost']: 4.0f}, " \
@@ -489,11 +675,9 @@ def train_loop(cfg: DictConfig,
     collector.shutdown()
     pbar.close()
 
-    if cfg.wandb.use_wandb:  # final evaluation
+    if cfg.wandb.use_wandb and is_main:  # final evaluation
         if cfg.environment.instances.test not in (None, 'None'):
-            optimal_test_scores = {
-                instance: np.load(hydra.utils.to_absolute_path(f'src/data/oracle/{instance}_cost.npy'))
-                for instance in cfg.environment.instances.test}
+            optimal_test_scores = load_optimal_scores(cfg.environment.instances.test)
             prefix = 'test'
         else:
             optimal_test_scores = optimal_valid_scores